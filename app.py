@@ -1,49 +1,255 @@
 import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request
 
 TOKEN = os.environ.get("TOKEN")
+API_URL = f"https://api.telegram.org/bot{TOKEN}"
+VIDEO_CACHE_SIZE = int(os.environ.get("VIDEO_CACHE_SIZE", "1000"))
+SEEN_UPDATES_SIZE = 1000
+# حداکثر تعداد دانلود/آپلود هم‌زمان
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+# سقف حجم آپلود فایل توسط ربات در Bot API
+MAX_VIDEO_SIZE = 50 * 1024 * 1024
+TOO_LARGE_MESSAGE = "حجم فایل بیشتر از ۵۰ مگابایت است."
+# فایل‌های کوچک‌تر از این در حافظه می‌مانند و روی دیسک نوشته نمی‌شوند
+SPOOL_SIZE = 10 * 1024 * 1024
+# (اتصال، خواندن) به ثانیه
+HTTP_TIMEOUT = (10, 60)
+# تلگرام پیش از پاسخ دادن خودش لینک را دانلود می‌کند و بیشتر طول می‌کشد
+URL_SEND_TIMEOUT = (10, 180)
 app = Flask(__name__)
+executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+# اتصال‌های HTTPS به Bot API بین درخواست‌ها دوباره استفاده می‌شوند؛
+# حداقل به اندازهٔ پیش‌فرض requests و برای هر worker یک اتصال.
+# دانلودها از این session استفاده نمی‌کنند تا کوکی‌های لینک یک کاربر
+# همراه دانلود کاربر دیگر فرستاده نشود.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=max(10, DOWNLOAD_WORKERS)))
 
-def send_message(chat_id, text):
-    requests.post(f"https://api.telegram.org/bot{TOKEN}/sendMessage", json={
+# تلگرام فایل را بسته به نوعش به یکی از این شکل‌ها ذخیره می‌کند
+SEND_METHODS = {
+    "video": "sendVideo",
+    "animation": "sendAnimation",
+    "document": "sendDocument"
+}
+
+# (نوع، file_id) فایل‌های ارسال‌شده به ازای هر لینک (LRU)
+video_cache = OrderedDict()
+video_cache_lock = threading.Lock()
+
+def get_cached_video(url):
+    with video_cache_lock:
+        ref = video_cache.get(url)
+        if ref:
+            video_cache.move_to_end(url)
+        return ref
+
+def cache_video(url, ref):
+    with video_cache_lock:
+        video_cache[url] = ref
+        video_cache.move_to_end(url)
+        while len(video_cache) > VIDEO_CACHE_SIZE:
+            video_cache.popitem(last=False)
+
+# update_id های اخیر؛ تلگرام در صورت خطا همان آپدیت را دوباره می‌فرستد
+seen_updates = OrderedDict()
+seen_updates_lock = threading.Lock()
+
+def is_new_update(update_id):
+    with seen_updates_lock:
+        if update_id in seen_updates:
+            return False
+        seen_updates[update_id] = None
+        while len(seen_updates) > SEEN_UPDATES_SIZE:
+            seen_updates.popitem(last=False)
+        return True
+
+# لینک‌هایی که در حال دانلودند
+downloads = {}
+downloads_lock = threading.Lock()
+
+def send_message(chat_id, text, disable_notification=False):
+    session.post(f"{API_URL}/sendMessage", json={
+        "chat_id": chat_id,
+        "text": text,
+        "disable_notification": disable_notification
+    }, timeout=HTTP_TIMEOUT)
+
+def send_video(chat_id, f):
+    r = session.post(f"{API_URL}/sendVideo",
+                     data={"chat_id": chat_id},
+                     files={"video": ("video.mp4", f)},
+                     timeout=HTTP_TIMEOUT)
+    return sent_result(r)
+
+def send_video_url(chat_id, url):
+    # تلگرام خودش لینک را دریافت می‌کند
+    r = session.post(f"{API_URL}/sendVideo", json={
         "chat_id": chat_id,
-        "text": text
-    })
+        "video": url
+    }, timeout=URL_SEND_TIMEOUT)
+    return sent_result(r)
+
+def send_cached(chat_id, ref):
+    kind, file_id = ref
+    # خطای ارسال مثل ارسال‌نشدن حساب می‌شود تا مسیر دانلود یا پیام خطا ادامه یابد
+    try:
+        r = session.post(f"{API_URL}/{SEND_METHODS[kind]}", json={
+            "chat_id": chat_id,
+            kind: file_id
+        }, timeout=HTTP_TIMEOUT)
+    except requests.RequestException:
+        app.logger.warning("sending cached %s failed", kind, exc_info=True)
+        return None
+    return sent_result(r)
+
+def sent_result(r):
+    # result پاسخ تلگرام اگر ارسال پذیرفته شده باشد، وگرنه None
+    try:
+        data = r.json()
+    except ValueError:
+        return None
+    return (data.get("result") or {}) if data.get("ok") else None
+
+def file_ref(result):
+    for kind in SEND_METHODS:
+        if kind in result:
+            return kind, result[kind]["file_id"]
+    return None
+
+GENERIC_ERROR = "خطا: مشکلی پیش آمد."
+DOWNLOAD_ERROR = "خطا: دانلود فایل ممکن نشد."
+# خطاهایی که به خود لینک مربوط‌اند و برای چت‌های منتظر هم معتبرند
+LINK_ERRORS = (TOO_LARGE_MESSAGE, DOWNLOAD_ERROR)
+
+def submit(fn, *args):
+    executor.submit(fn, *args).add_done_callback(log_failure)
+
+def log_failure(future):
+    # خطاهای خارج از try در handle_link در غیر این صورت گم می‌شوند
+    error = future.exception()
+    if error is not None:
+        app.logger.error("handling link failed", exc_info=error)
+
+def handle_link(chat_id, url, notify=True):
+    # این لینک قبلاً آپلود شده؛ بدون دانلود دوباره ارسال می‌شود
+    ref = get_cached_video(url)
+    if ref and send_cached(chat_id, ref) is not None:
+        return
+
+    # پیش از ثبت در downloads، تا اگر این پیام خطا داد چیزی معلق نماند
+    if notify:
+        send_message(chat_id, "در حال دانلود...", disable_notification=True)
 
-def send_video(chat_id, file_path):
-    with open(file_path, "rb") as f:
-        requests.post(f"https://api.telegram.org/bot{TOKEN}/sendVideo",
-                      data={"chat_id": chat_id},
-                      files={"video": f})
+    # اگر همین لینک در حال دانلود است، نتیجهٔ همان دانلود به این چت هم می‌رسد
+    with downloads_lock:
+        pending = downloads.get(url)
+        if pending is None:
+            downloads[url] = Future()
+    if pending is not None:
+        pending.add_done_callback(
+            lambda f: submit(reply_pending, chat_id, url, f.result()))
+        return
+
+    ref, error = None, GENERIC_ERROR
+    try:
+        ref, error = fetch_link(chat_id, url)
+        if ref:
+            cache_video(url, ref)
+    finally:
+        with downloads_lock:
+            done = downloads.pop(url)
+        # خطای ارسال به این چت (مثلاً ربات مسدود شده) به چت‌های دیگر ربطی ندارد
+        done.set_result((ref, error if error in LINK_ERRORS else None))
+
+    if error:
+        send_message(chat_id, error)
+
+def reply_pending(chat_id, url, outcome):
+    ref, error = outcome
+    if ref and send_cached(chat_id, ref) is not None:
+        return
+    if error:
+        send_message(chat_id, error)
+    else:
+        # تلاش اول برای این چت قابل استفاده نیست؛ خودش دوباره امتحان می‌کند
+        handle_link(chat_id, url, notify=False)
+
+def fetch_link(chat_id, url):
+    # خروجی: (نوع و file_id فایل ارسال‌شده، متن خطا برای کاربر)
+    try:
+        # اول تلگرام خودش لینک را دریافت می‌کند (تا ۲۰ مگابایت)؛
+        # فقط اگر نشد فایل از اینجا دانلود و آپلود می‌شود
+        try:
+            result = send_video_url(chat_id, url)
+        # شاید تلگرام هنوز در حال دریافت باشد و ویدیو را بفرستد؛
+        # پس نه دوباره ارسال می‌شود و نه خطایی به کاربر گفته می‌شود
+        except requests.ReadTimeout:
+            app.logger.warning("sending %s by url timed out", url)
+            return None, None
+        except requests.RequestException:
+            app.logger.warning("sending %s by url failed", url, exc_info=True)
+            result = None
+        if result is not None:
+            return file_ref(result), None
+
+        # هر درخواست فایل موقت خودش را دارد که در هر حالت پاک می‌شود
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE,
+                                           suffix=".mp4") as f:
+            # دانلود فایل
+            try:
+                with requests.get(url, stream=True, timeout=HTTP_TIMEOUT) as r:
+                    r.raise_for_status()
+                    # فایل‌هایی که تلگرام نمی‌پذیرد دانلود نمی‌شوند
+                    if int(r.headers.get("Content-Length") or 0) > MAX_VIDEO_SIZE:
+                        return None, TOO_LARGE_MESSAGE
+
+                    # بدون Content-Length هم بیشتر از سقف دانلود نمی‌شود
+                    size = 0
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        size += len(chunk)
+                        if size > MAX_VIDEO_SIZE:
+                            return None, TOO_LARGE_MESSAGE
+                        f.write(chunk)
+            except requests.RequestException:
+                app.logger.warning("downloading %s failed", url, exc_info=True)
+                return None, DOWNLOAD_ERROR
+
+            # ارسال به تلگرام
+            f.seek(0)
+            result = send_video(chat_id, f)
+            if result is None:
+                return None, "خطا: تلگرام این فایل را نپذیرفت."
+            return file_ref(result), None
+
+    # متن خطاهای requests شامل آدرس API و توکن ربات است؛ فقط لاگ می‌شود
+    except requests.RequestException:
+        app.logger.warning("fetching or sending %s failed", url, exc_info=True)
+        return None, "خطا: دریافت یا ارسال فایل ممکن نشد."
+
+    except Exception:
+        app.logger.exception("handling %s failed", url)
+        return None, GENERIC_ERROR
 
 @app.route("/", methods=["POST"])
 def webhook():
     data = request.json
 
+    update_id = data.get("update_id")
+    if update_id is not None and not is_new_update(update_id):
+        return "ok"
+
     if "message" in data:
         chat_id = data["message"]["chat"]["id"]
         url = data["message"].get("text", "")
 
         if url.startswith("http"):
-            send_message(chat_id, "در حال دانلود...")
-
-            try:
-                file_path = "video.mp4"
-
-                # دانلود فایل
-                r = requests.get(url, stream=True)
-                with open(file_path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-
-                # ارسال به تلگرام
-                send_video(chat_id, file_path)
-
-                os.remove(file_path)
-
-            except Exception as e:
-                send_message(chat_id, f"خطا: {str(e)}")
+            # دانلود و آپلود خارج از درخواست وب‌هوک انجام می‌شود
+            submit(handle_link, chat_id, url)
 
-    return "ok"
\ No newline at end of file
+    return "ok"